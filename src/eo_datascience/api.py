@@ -22,7 +22,7 @@ def main():
         default="eo-datascience-cookbook",
     )
     args = parser.parse_args()
-    render_toc(p=Path("_quarto.yml").absolute().as_posix(), out=args.out)
+    render_toc(p=Path("_quarto.yml").absolute(), out=args.out)
     clean_nb(args.dir, Path(args.out) / Path("notebooks"))
     merge_envs(args.name, Path(args.out))
 
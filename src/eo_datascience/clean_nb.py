@@ -1,8 +1,40 @@
+import json
+import os
 import re
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from pathlib import Path
 
 import nbformat
 
+_NOTE_RE = re.compile(r":::\s\{\.callout\-note\}(.+?):::", re.DOTALL)
+_FIG_RE = re.compile(r"\(@[^\)]+\)")
+_PERSON_RE = re.compile(r"\[@([^\]]+)\]")
+_TIME_RE = re.compile(r"(?<!\[)@([^\s]+)")
+
+
+def read_notebook(nb_path):
+    data = Path(nb_path).read_bytes()
+    nb_dict = json.loads(data)
+    major, _ = nbformat.reader.get_version(nb_dict)
+    # Skip the schema validation of nbformat.read for v4 notebooks
+    if major == 4:
+        return nbformat.v4.to_notebook_json(nb_dict)
+    return nbformat.reads(data, as_version=4)
+
+
+def process_notebook(nb_path, dir, out=None):
+    nb = read_notebook(nb_path)
+    # Apply all transformations in memory and keep track of changes
+    dirty = _apply_frontmatter(nb)
+    dirty |= _apply_kernelspec(nb)
+    dirty |= _apply_callout_notes(nb)
+    dirty |= _apply_refs(nb)
+    # Save notebook
+    out_path = substitute_path(nb_path, dir, out)
+    if dirty or out_path != Path(nb_path):
+        nbformat.write(nb, out_path)
+
 
 def set_kernel_all_notebooks(
     dir="./notebooks",
@@ -10,60 +42,59 @@ def set_kernel_all_notebooks(
     save=True,
     name="python3",
     display_name="Python 3 (ipykernel)",
+    nb=None,
 ):
-    nb_paths = find_ipynb(dir)
-    for nb_path in nb_paths:
-        nb = nbformat.read(nb_path, as_version=4)
-        nb.metadata.kernelspec.name = name
-        nb.metadata.kernelspec.display_name = display_name
-        # Save notebook
-        nb_path = substitute_path(nb_path, dir, out)
-        if save:
-            nbformat.write(nb, nb_path)
-        else:
-            return nb
+    # Short-circuit reading from disk for an already loaded notebook
+    if nb is not None:
+        _apply_kernelspec(nb, name, display_name)
+        return nb
+    return _transform_all_notebooks(
+        dir, out, save, lambda nb: _apply_kernelspec(nb, name, display_name)
+    )
+
+
+def _apply_kernelspec(nb, name="python3", display_name="Python 3 (ipykernel)"):
+    kernelspec = nb.metadata.kernelspec
+    dirty = kernelspec.name != name or kernelspec.display_name != display_name
+    kernelspec.name = name
+    kernelspec.display_name = display_name
+    return dirty
 
 
 def clean_up_frontmatter(dir="./notebooks", out=None, save=True):
-    # Define the path to the notebooks
-    nb_paths = find_ipynb(dir)
+    return _transform_all_notebooks(dir, out, save, _apply_frontmatter)
 
-    # Iterate over the notebooks
-    for nb_path in nb_paths:
-        # Load the notebook
-        nb = nbformat.read(nb_path, as_version=4)
-        if nb.cells[0].source.startswith("---"):
-            # Load frontmatter
-            fm = nb.cells[0].source.split("\n")
-
-            # Extract the title and the subtitle and convert
-            i = 1
-            line = fm[i]
-            new_text = []
-            while not line.startswith("---"):
-                if line.startswith("title"):
-                    new_text.append(f"# {line.split(': ')[1]}")
-                if line.startswith("subtitle"):
-                    new_text.append(f"**{line.split(': ')[1]}**")
-
-                i += 1
-                line = fm[i]
-
-            new_text += fm[i + 1 :]  # noqa
-            nb.cells[0].source = "\n".join(new_text) + "\n"
-            nb.cells[0].cell_type = "markdown"
-        # Save notebook
-        nb_path = substitute_path(nb_path, dir, out)
-        if save:
-            nbformat.write(nb, nb_path)
-        else:
-            return nb
+
+def _apply_frontmatter(nb):
+    if not nb.cells[0].source.startswith("---"):
+        return False
+
+    # Load frontmatter
+    fm = nb.cells[0].source.split("\n")
+
+    # Extract the title and the subtitle and convert
+    i = 1
+    line = fm[i]
+    new_text = []
+    while not line.startswith("---"):
+        if line.startswith("title"):
+            new_text.append(f"# {line.split(': ')[1]}")
+        if line.startswith("subtitle"):
+            new_text.append(f"**{line.split(': ')[1]}**")
+
+        i += 1
+        line = fm[i]
+
+    new_text += fm[i + 1 :]  # noqa
+    nb.cells[0].source = "\n".join(new_text) + "\n"
+    nb.cells[0].cell_type = "markdown"
+    return True
 
 
 def convert_bibliography(nb_path="./notebooks/references.ipynb", out=None, save=True):
     nb_path = Path(nb_path)
     if nb_path.exists():
-        nb = nbformat.read(nb_path, as_version=4)
+        nb = read_notebook(nb_path)
         nb.cells[0].source = """# References
 ```{bibliography}
 :style: plain
@@ -78,49 +109,51 @@ def convert_bibliography(nb_path="./notebooks/references.ipynb", out=None, save=
 
 
 def convert_callout_notes(dir="./notebooks", out=None, save=True):
-    nb_paths = find_ipynb(dir)
+    return _transform_all_notebooks(dir, out, save, _apply_callout_notes)
 
-    # Iterate over the notebooks
-    for nb_path in nb_paths:
-        # Load the notebook
-        nb = nbformat.read(nb_path, as_version=4)
-        for i in range(len(nb.cells)):
-            if nb.cells[i]["cell_type"] == "markdown":
-                nb.cells[i].source = quarto_note_replace(nb.cells[i].source)
-        # Save the notebook
-        nb_path = substitute_path(nb_path, dir, out)
-        if save:
-            nbformat.write(nb, nb_path)
-        else:
-            return nb
+
+def _apply_callout_notes(nb):
+    return _replace_markdown(nb, quarto_note_replace)
 
 
 def quarto_note_replace(quarto):
-    note_rst_start = r":::{note}"
-    note_rst_end = r":::"
-    nts = re.findall(r"(?<=:::\s\{\.callout\-note\})[^:::]+", quarto)
-    for i in nts:
-        quarto = re.sub(
-            r":::\s\{\.callout\-note\}" + re.escape(i) + r":::",
-            note_rst_start + i + note_rst_end,
-            quarto,
-        )
-    return quarto
+    return _NOTE_RE.sub(r":::{note}\1:::", quarto)
 
 
 def convert_refs(dir="./notebooks", out=None, save=True):
+    return _transform_all_notebooks(dir, out, save, _apply_refs)
+
+
+def _apply_refs(nb):
+    return _replace_markdown(
+        nb,
+        quarto_ref_figure_replace,
+        quarto_ref_person_replace,
+        quarto_ref_time_replace,
+    )
+
+
+def _replace_markdown(nb, *replacements):
+    dirty = False
+    for cell in nb.cells:
+        if cell["cell_type"] == "markdown":
+            source = cell.source
+            for replace in replacements:
+                source = replace(source)
+            if source != cell.source:
+                cell.source = source
+                dirty = True
+    return dirty
+
+
+def _transform_all_notebooks(dir, out, save, transform):
     nb_paths = find_ipynb(dir)
 
     # Iterate over the notebooks
     for nb_path in nb_paths:
         # Load the notebook
-        nb = nbformat.read(nb_path, as_version=4)
-        for i in range(len(nb.cells)):
-            if nb.cells[i]["cell_type"] == "markdown":
-                nb.cells[i].source = quarto_ref_figure_replace(nb.cells[i].source)
-                nb.cells[i].source = quarto_ref_person_replace(nb.cells[i].source)
-                nb.cells[i].source = quarto_ref_time_replace(nb.cells[i].source)
-
+        nb = read_notebook(nb_path)
+        transform(nb)
         # Save the notebook
         nb_path = substitute_path(nb_path, dir, out)
         if save:
@@ -130,28 +163,25 @@ def convert_refs(dir="./notebooks", out=None, save=True):
 
 
 def quarto_ref_figure_replace(quarto):
-    bibs = re.findall(r"(?<=\(\@)[^\)]+", quarto)
-    for i in bibs:
-        quarto = re.sub(r"\(\@" + i + r"\)", "", quarto)
-    return quarto
+    return _FIG_RE.sub("", quarto)
 
 
 def quarto_ref_person_replace(quarto):
-    bibs = re.findall(r"(?<=\[\@)[^\]]+", quarto)
-    for i in bibs:
-        quarto = re.sub(r"\[\@" + i + r"\]", r"{cite:p}`" + i + "`", quarto)
-    return quarto
+    return _PERSON_RE.sub(r"{cite:p}`\1`", quarto)
 
 
 def quarto_ref_time_replace(quarto):
-    bibs = re.findall(r"(?<=\@)[^\s]+", quarto)
-    for i in bibs:
-        quarto = re.sub(r"\@" + i, r"{cite:t}`" + i + "`", quarto)
-    return quarto
+    return _TIME_RE.sub(r"{cite:t}`\1`", quarto)
 
 
 def find_ipynb(dir):
-    return list(Path(dir).rglob("*.ipynb"))
+    nb_paths = []
+    for root, dirs, files in os.walk(dir):
+        # Do not descend into the copies Jupyter keeps in checkpoint directories
+        dirs[:] = [d for d in dirs if d != ".ipynb_checkpoints"]
+        root = Path(root)
+        nb_paths += [root / f for f in files if f.endswith(".ipynb")]
+    return nb_paths
 
 
 def substitute_path(nb_path, dir, out):
@@ -163,8 +193,8 @@ def substitute_path(nb_path, dir, out):
 
 
 def clean_nb(dir, out):
-    clean_up_frontmatter(dir, out)
-    set_kernel_all_notebooks(out)
-    convert_callout_notes(out)
-    convert_refs(out)
+    nb_paths = find_ipynb(dir)
+    # Notebooks are independent of each other, process them in parallel
+    with ProcessPoolExecutor() as executor:
+        list(executor.map(process_notebook, nb_paths, repeat(dir), repeat(out)))
     convert_bibliography(out=out)
@@ -3,10 +3,23 @@
 from __future__ import annotations
 
 import argparse
-from pathlib import Path, PurePath
+import functools
+from pathlib import Path
 
 import yaml  # type: ignore
-from packaging.version import parse
+from packaging.version import Version, parse
+
+try:
+    from yaml import CSafeLoader as _Loader  # type: ignore
+except ImportError:
+    from yaml import SafeLoader as _Loader  # type: ignore
+
+
+class _IndentDumper(yaml.SafeDumper):
+    """Dumper that indents list items relative to their parent key."""
+
+    def increase_indent(self, flow=False, indentless=False):
+        return super().increase_indent(flow, False)
 
 
 def collect_yaml_files(root: Path) -> list[Path]:
@@ -16,10 +29,14 @@ def collect_yaml_files(root: Path) -> list[Path]:
     return files
 
 
+@functools.cache
 def get_environment_from_yml(file: Path) -> dict:
-    """Load a yaml into a dictionary."""
-    with file.open("r") as f:
-        return yaml.safe_load(f)
+    """Load a yaml into a dictionary.
+
+    The result is cached per file and should therefore not be mutated.
+    """
+    with file.open("rb") as f:
+        return yaml.load(f, Loader=_Loader) or {}
 
 
 def aggregate_env_dependencies(files: list[Path]) -> tuple[list[str], list[str]]:
@@ -53,49 +70,36 @@ def extract_sub_dependencies(deps: list[str | dict], file: Path) -> tuple[list,
     return regular_deps, subdependencies
 
 
-def relative_path_custom_package(pip_deps, file: Path):
-    for i, pip_dep in enumerate(pip_deps):
-        if pip_dep == ".":
-            pip_deps[i] = str(PurePath(file).parent.relative_to(Path.cwd()))
-    return pip_deps
+def relative_path_custom_package(pip_deps: list[str], file: Path) -> list[str]:
+    """Replace the local package "." with its path relative to the cwd."""
+    if "." not in pip_deps:
+        return list(pip_deps)
+    package = str(file.resolve().parent.relative_to(Path.cwd()))
+    return [package if pip_dep == "." else pip_dep for pip_dep in pip_deps]
+
 
+def resolve_versions(deps: list[str]) -> set[str]:
+    """Resolve the dependencies to their latest specified versions.
 
-def separate_dependencies(dep: list[str]) -> tuple[set, dict]:
-    """Separates all dependencies into unique and non-unique dependencies."""
-    unique_deps = set()
-    non_unique_deps: dict = {}
-    for d in dep:
+    Each version string is parsed only once while the latest version per
+    dependency is tracked in a single pass over the dependencies.
+    """
+    latest: dict[str, tuple[Version, str] | None] = {}
+    for d in deps:
         parts = d.split("=")
         name = parts[0]
-        # NOTE: All dependencies are added to the unique's
-        unique_deps.add(name)
         # Check if version is specified
         if len(parts) > 1:
             version = parts[-1]
-            if name in non_unique_deps:
-                non_unique_deps[name].append(version)
-            else:
-                non_unique_deps[name] = [version]
-    return unique_deps, non_unique_deps
-
-
-def resolve_dependency_versions(unique_deps: set, non_unique_deps: dict) -> set:
-    """Add latest versions from the non-unique to the unique dependencies."""
-    final_dependencies = set()
-    for name in unique_deps:
-        if name in non_unique_deps:
-            latest_version = max(non_unique_deps[name], key=parse)
-            final_dependencies.add(f"{name}=={latest_version}")
+            parsed = parse(version)
+            current = latest.get(name)
+            if current is None or parsed > current[0]:
+                latest[name] = (parsed, version)
         else:
-            final_dependencies.add(name)
-    return final_dependencies
-
-
-def resolve_versions(dep: list[str]) -> set:
-    unique, non_unique = separate_dependencies(dep)
-
-    # Update dependencies set with latest versions
-    return resolve_dependency_versions(unique, non_unique)
+            latest.setdefault(name, None)
+    return {
+        name if best is None else f"{name}=={best[1]}" for name, best in latest.items()
+    }
 
 
 def create_master_environment(
@@ -120,6 +124,7 @@ def dump_environment(out: Path, master_env: dict) -> None:
         yaml.dump(
             master_env,
             f,
+            Dumper=_IndentDumper,
             default_flow_style=False,
             sort_keys=False,
             indent=2,
@@ -127,19 +132,6 @@ def dump_environment(out: Path, master_env: dict) -> None:
         )
 
 
-def fix_yml_indentation(output_file: Path) -> None:
-    """Fix the indentation of a file, which has been yaml dumped."""
-    with output_file.open() as f:
-        lines = f.readlines()
-
-    with output_file.open("w") as f:
-        for line in lines:
-            if line.strip().startswith("-"):
-                f.write("  " + line)  # Add two spaces before the line
-            else:
-                f.write(line)
-
-
 def merge_envs(name: str, out: Path):
     root = Path("notebooks").resolve()
     files: list[Path] = collect_yaml_files(root)
@@ -157,9 +149,6 @@ def merge_envs(name: str, out: Path):
         final_dependencies, name=name, pip_deps=final_pip_dependencies
     )
     dump_environment(out, master_env)
-
-    # Dirty fix: Read the file and add two spaces before
-    fix_yml_indentation(out / "environment.yml")
     print("Environments have been merged.")
     print(f"{out} file created successfully.")
 
@@ -1,22 +1,49 @@
+import functools
+import os
 from pathlib import Path
 
 import yaml
-from eo_datascience.clean_nb import substitute_path
+
+try:
+    from yaml import CSafeDumper as _Dumper
+    from yaml import CSafeLoader as _Loader
+except ImportError:
+    from yaml import SafeDumper as _Dumper
+    from yaml import SafeLoader as _Loader
 
 
 def render_toc(p, out="."):
     with open(p, "r") as ff:
-        quarto_toc = yaml.safe_load(ff)
+        quarto_toc = yaml.load(ff, Loader=_Loader)
     toc = _render_toc(quarto_toc)
-    with open((Path(out) / "_toc.yml").resolve().as_posix(), "w+") as ff:
-        yaml.dump(toc, ff)
+    with open(Path(out) / "_toc.yml", "w+") as ff:
+        yaml.dump(toc, ff, Dumper=_Dumper)
 
 
 def _render_toc(toc):
-    ls = [dict(caption="Preamble", chapters=[dict(file="notebooks/how-to-cite")])]
-    ls += [transform_main(toc)] + transform_appendix(toc)
-    ls += [dict(caption="References", chapters=[dict(file="notebooks/references")])]
-    return dict(format="jb-book", root="README", parts=ls)
+    existing = existing_chapters()
+    return dict(
+        format="jb-book",
+        root="README",
+        parts=[
+            dict(caption="Preamble", chapters=[dict(file="notebooks/how-to-cite")]),
+            transform_main(toc, existing),
+            *transform_appendix(toc, existing),
+            dict(caption="References", chapters=[dict(file="notebooks/references")]),
+        ],
+    )
+
+
+def existing_chapters(root="chapters"):
+    # Snapshot the chapter files once instead of a stat per TOC entry
+    root = Path(root)
+    if not root.is_dir():
+        return None
+    return frozenset(
+        (Path(dirpath) / f).as_posix()
+        for dirpath, _, files in os.walk(root)
+        for f in files
+    )
 
 
 def extract_main(toc):
@@ -27,75 +54,54 @@ def extract_appendix(toc):
     return toc["book"]["appendices"][:-1]
 
 
-def transform_main(toc):
-    return rename_keys_sections_main(extract_main(toc))
+def transform_main(toc, existing=None):
+    return rename_keys_sections_main(extract_main(toc), existing)
 
 
-def transform_appendix(toc):
-    return rename_keys_sections_appendix(extract_appendix(toc))
+def transform_appendix(toc, existing=None):
+    return rename_keys_sections_appendix(extract_appendix(toc), existing)
 
 
-def rename_keys_sections_main(sections):
-    sections = sections.copy()
-    list_of_chapters_files = []
-    new_struct_toc = dict()
-    for i, section in enumerate(sections):
-        sections[i] = _rename_keys_section(section, ("part", "caption"))
-        restructure_section_main(sections, i, list_of_chapters_files)
-    new_struct_toc["caption"] = "Courses"
-    new_struct_toc["chapters"] = list_of_chapters_files
-    return new_struct_toc
+def rename_keys_sections_main(sections, existing=None):
+    return {
+        "caption": "Courses",
+        "chapters": [_restructure_section(i, existing) for i in sections],
+    }
 
 
-def rename_keys_sections_appendix(sections):
-    sections = sections.copy()
-    for i, section in enumerate(sections):
-        sections[i] = _rename_keys_section(section, ("part", "caption"))
-        restructure_section_appendix(sections, i)
-    return sections
+def rename_keys_sections_appendix(sections, existing=None):
+    chapters = [_restructure_section(i, existing) for i in sections]
+    return [
+        {"caption": i["file"].split("/")[1].capitalize(), "chapters": [i]}
+        for i in chapters
+    ]
 
 
-def restructure_section_main(sections, i, list_of_chapters_files):
-    return list_of_chapters_files.append(
-        {
-            "file": sections[i]["caption"][0]["file"],
-            "sections": sections[i]["chapters"],
-        }
-    )
+def _restructure_section(section, existing=None):
+    chapters = section["chapters"]
+    if not isinstance(chapters, list):
+        chapters = [chapters]
+    files = [rename_file_path(i, existing) for i in chapters]
+    return {
+        "file": rename_file_path(section["part"], existing),
+        "sections": [{"file": i} for i in files],
+    }
 
 
-def restructure_section_appendix(sections, i):
-    restruct = [
-        {
-            "file": sections[i]["caption"][0]["file"],
-            "sections": sections[i]["chapters"],
-        }
-    ]
-    name = sections[i]["caption"][0]["file"].split("/")[1]
-    sections[i]["chapters"] = restruct
-    sections[i]["caption"] = name.capitalize()
-
-
-def _rename_keys_section(section, key_rename):
-    keys = [i.replace(*key_rename) for i in section.keys()]
-    section = dict(zip(keys, section.values()))
-
-    for key in section.keys():
-        try:
-            file_path = section[key]
-            if not isinstance(file_path, list):
-                file_path = [file_path]
-            section[key] = [{"file": rename_file_path(i)} for i in file_path]
-        except KeyError:
-            pass
-    return section
-
-
-def rename_file_path(file_path):
-    if Path(file_path).exists():
-        file_path = str(
-            substitute_path(file_path, "chapters", "notebooks").with_suffix("")
-        )
+def rename_file_path(file_path, existing=None):
+    if existing is None or not file_path.startswith("chapters/"):
+        exists = _path_exists(file_path)
+    else:
+        exists = file_path in existing
+    if exists:
+        if file_path.startswith("chapters/"):
+            file_path = "notebooks/" + file_path.removeprefix("chapters/")
+        file_path = os.path.splitext(file_path)[0]
     else:
         KeyError("File does not exist")
     return file_path
+
+
+@functools.cache
+def _path_exists(file_path):
+    return Path(file_path).exists()
@@ -1,7 +1,6 @@
 from pathlib import Path
 from unittest.mock import patch
 
-import pytest  # noqa
 from eo_datascience import merge_envs  # type: ignore
 
 
@@ -19,24 +18,23 @@ def test_create_master_environment_returns_correct():
     assert actual_result == expected_result
 
 
-def test_resolve_dependency_versions_returns_correct():
-    dependencies = ["numpy", "pandas", "matplotlib"]
-    multiple_versions = {"matplotlib": ["3.2.2", "3.3.0", "3.3.1"]}
+def test_resolve_versions_returns_correct():
+    dependencies = [
+        "numpy",
+        "pandas",
+        "matplotlib=3.2.2",
+        "matplotlib==3.3.1",
+        "matplotlib",
+        "matplotlib=3.3.0",
+    ]
     expected_result = {"matplotlib==3.3.1", "numpy", "pandas"}
-    actual_result = merge_envs.resolve_dependency_versions(
-        dependencies, multiple_versions
-    )
+    actual_result = merge_envs.resolve_versions(dependencies)
     assert actual_result == expected_result
 
 
-def test_extract_unique_dependencies_returns_correct():
-    dependencies = ["numpy", "pandas", "matplotlib==3.2.2", "matplotlib==3.1.1"]
-    expected_result = (
-        {"numpy", "pandas", "matplotlib"},
-        {"matplotlib": ["3.2.2", "3.1.1"]},
-    )
-    actual_result = merge_envs.separate_dependencies(dependencies)
-    assert actual_result == expected_result
+def test_resolve_versions_compares_parsed_versions():
+    dependencies = ["xarray=2024.9.0", "xarray=2024.10.0"]
+    assert merge_envs.resolve_versions(dependencies) == {"xarray==2024.10.0"}
 
 
 @patch("eo_datascience.merge_envs.get_environment_from_yml")
@@ -70,3 +68,45 @@ def test_aggregate_env_dependencies_returns_correct(mock_get_env):
     expected_pip = ["pyyaml", "quarto", "."]
     assert result == expected
     assert pip == expected_pip
+
+
+def test_relative_path_custom_package_returns_correct():
+    pip_deps = ["pyyaml", "."]
+    file = Path("notebooks/tutorials/env.yml")
+
+    actual_result = merge_envs.relative_path_custom_package(pip_deps, file)
+
+    assert actual_result == ["pyyaml", "notebooks/tutorials"]
+    # The input may come from the environment cache and must stay untouched
+    assert pip_deps == ["pyyaml", "."]
+
+
+def test_relative_path_custom_package_without_local_package(tmp_path):
+    pip_deps = ["numpy"]
+    # Files outside the cwd are fine as long as there is no local package
+    file = tmp_path / "env.yml"
+
+    actual_result = merge_envs.relative_path_custom_package(pip_deps, file)
+
+    assert actual_result == ["numpy"]
+    assert actual_result is not pip_deps
+
+
+def test_dump_environment_indents_sequences(tmp_path):
+    master_env = merge_envs.create_master_environment(
+        {"numpy", "xarray==2024.10.0"}, name="eo-datascience", pip_deps={"pyyaml"}
+    )
+    expected = (
+        "name: eo-datascience\n"
+        "channels:\n"
+        "  - conda-forge\n"
+        "dependencies:\n"
+        "  - numpy\n"
+        "  - xarray==2024.10.0\n"
+        "  - pip:\n"
+        "      - pyyaml\n"
+    )
+
+    merge_envs.dump_environment(tmp_path, master_env)
+
+    assert (tmp_path / "environment.yml").read_text() == expected
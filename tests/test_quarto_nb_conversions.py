@@ -1,22 +1,32 @@
+import copy
+import os
 import re
+import shutil
 from pathlib import Path
 
-import nbformat  # noqa
-import pytest  # noqa
+import nbformat
+import pytest
 import yaml
 from eo_datascience.clean_nb import (
+    _apply_kernelspec,
+    _replace_markdown,
+    clean_nb,
     clean_up_frontmatter,
     convert_callout_notes,
     convert_refs,
     find_ipynb,
+    process_notebook,
     quarto_note_replace,
+    quarto_ref_figure_replace,
     quarto_ref_person_replace,
     quarto_ref_time_replace,
+    read_notebook,
     set_kernel_all_notebooks,
     substitute_path,
 )
 from eo_datascience.render_sfinx_toc import (
     _render_toc,
+    existing_chapters,
     extract_appendix,
     extract_main,
     rename_file_path,
@@ -26,73 +36,119 @@ from eo_datascience.render_sfinx_toc import (
     transform_main,
 )
 
+try:
+    from yaml import CSafeLoader as _Loader
+except ImportError:
+    from yaml import SafeLoader as _Loader
 
-def test_toc_conversion():
-    mock_quarto_toc = """
-    project:
-      type: book
-      pre-render:
-        - make kernel
-      post-render:
-        - quarto convert chapters/references.qmd
-        - make post-render
-
-    book:
-      title: "Earth Observation Datascience"
-      author: ""
-      date: "10 January 2025"
-      chapters:
-        - index.qmd
-        - part: chapters/courses/microwave-remote-sensing.qmd
-          chapters:
-            - chapters/courses/microwave-remote-sensing/unit_01/01_in_class_exercise.qmd
-            - chapters/courses/microwave-remote-sensing/unit_01/02_in_class_exercise.qmd
-        - part: chapters/courses/environmental-remote-sensing.qmd
-          chapters:
-            - chapters/courses/environmental-remote-sensing/unit_01/01_handout_drought.qmd
-      appendices:
-        - part: chapters/templates/prereqs-templates.qmd
-          chapters:
-            - chapters/templates/classification.qmd
-        - part: chapters/tutorials/prereqs-tutorials.qmd
-          chapters:
-            - chapters/tutorials/floodmapping.qmd
-        - chapters/references.qmd
-    """
-
-    mock_jb_toc = """
-    format: jb-book
-    root: README
-    parts:
-    - caption: Preamble
-      chapters:
-        - file: notebooks/how-to-cite
-    - caption: Courses
+
+_FRONTMATTER_RE = re.compile(
+    r"# This a mock Jupyter file\n\*\*We use it for testing\*\*"
+)
+_REFS_RE = re.compile(
+    r"lorem ipsum {cite:p}`anon2024` and {cite:p}`anon2025` and lorem ipsum "
+    r"{cite:t}`anon2024` and {cite:t}`anon2025`\n"
+)
+_EXPECTED_NOTE_RE = re.compile(r":::{note}\nThis a callout note.\n:::")
+
+
+def _load(stream):
+    return yaml.load(stream, Loader=_Loader)
+
+
+MOCK_QUARTO_TOC = """
+project:
+  type: book
+  pre-render:
+    - make kernel
+  post-render:
+    - quarto convert chapters/references.qmd
+    - make post-render
+
+book:
+  title: "Earth Observation Datascience"
+  author: ""
+  date: "10 January 2025"
+  chapters:
+    - index.qmd
+    - part: chapters/courses/microwave-remote-sensing.qmd
       chapters:
-      - file: notebooks/courses/microwave-remote-sensing
-        sections:
-          - file: notebooks/courses/microwave-remote-sensing/unit_01/01_in_class_exercise
-          - file: notebooks/courses/microwave-remote-sensing/unit_01/02_in_class_exercise
-      - file: notebooks/courses/environmental-remote-sensing
-        sections:
-          - file: notebooks/courses/environmental-remote-sensing/unit_01/01_handout_drought
-    - caption: Templates
+        - chapters/courses/microwave-remote-sensing/unit_01/01_in_class_exercise.qmd
+        - chapters/courses/microwave-remote-sensing/unit_01/02_in_class_exercise.qmd
+    - part: chapters/courses/environmental-remote-sensing.qmd
       chapters:
-      - file: notebooks/templates/prereqs-templates
-        sections:
-          - file: notebooks/templates/classification
-    - caption: Tutorials
+        - chapters/courses/environmental-remote-sensing/unit_01/01_handout_drought.qmd
+  appendices:
+    - part: chapters/templates/prereqs-templates.qmd
       chapters:
-      - file: notebooks/tutorials/prereqs-tutorials
-        sections:
-          - file: notebooks/tutorials/floodmapping
-    - caption: References
+        - chapters/templates/classification.qmd
+    - part: chapters/tutorials/prereqs-tutorials.qmd
       chapters:
-        - file: notebooks/references
-    """
+        - chapters/tutorials/floodmapping.qmd
+    - chapters/references.qmd
+"""
+
+EXPECTED_JB_TOC = {
+    "format": "jb-book",
+    "root": "README",
+    "parts": [
+        {"caption": "Preamble", "chapters": [{"file": "notebooks/how-to-cite"}]},
+        {
+            "caption": "Courses",
+            "chapters": [
+                {
+                    "file": "notebooks/courses/microwave-remote-sensing",
+                    "sections": [
+                        {
+                            "file": "notebooks/courses/microwave-remote-"
+                            + "sensing/unit_01/01_in_class_exercise"
+                        },
+                        {
+                            "file": "notebooks/courses/microwave-remote-"
+                            + "sensing/unit_01/02_in_class_exercise"
+                        },
+                    ],
+                },
+                {
+                    "file": "notebooks/courses/environmental-remote-sensing",
+                    "sections": [
+                        {
+                            "file": "notebooks/courses/environmental-remote-"
+                            + "sensing/unit_01/01_handout_drought"
+                        },
+                    ],
+                },
+            ],
+        },
+        {
+            "caption": "Templates",
+            "chapters": [
+                {
+                    "file": "notebooks/templates/prereqs-templates",
+                    "sections": [{"file": "notebooks/templates/classification"}],
+                }
+            ],
+        },
+        {
+            "caption": "Tutorials",
+            "chapters": [
+                {
+                    "file": "notebooks/tutorials/prereqs-tutorials",
+                    "sections": [{"file": "notebooks/tutorials/floodmapping"}],
+                }
+            ],
+        },
+        {"caption": "References", "chapters": [{"file": "notebooks/references"}]},
+    ],
+}
 
-    quarto_toc = yaml.safe_load(mock_quarto_toc)
 
+@pytest.fixture(scope="module")
+def quarto_toc():
+    return _load(MOCK_QUARTO_TOC)
+
+
+def test_toc_conversion(quarto_toc):
     main = extract_main(quarto_toc)
     assert len(main) == 2
     assert rename_file_path("tests/mock.qmd") == "tests/mock"
@@ -159,59 +215,248 @@ def test_toc_conversion():
     quarto_toc_transform = transform_appendix(quarto_toc)
     assert len(append) == len(quarto_toc_transform)
 
-    assert _render_toc(quarto_toc) == yaml.safe_load(mock_jb_toc)
+    assert _render_toc(quarto_toc) == EXPECTED_JB_TOC
 
 
-def test_remove_front_matter():
+def test_rename_file_path_with_snapshot():
+    existing = frozenset({"chapters/courses/microwave-remote-sensing.qmd"})
+    assert (
+        rename_file_path("chapters/courses/microwave-remote-sensing.qmd", existing)
+        == "notebooks/courses/microwave-remote-sensing"
+    )
+    # Chapters missing from the snapshot are not renamed, even if on disk
+    assert (
+        rename_file_path("chapters/references.qmd", existing)
+        == "chapters/references.qmd"
+    )
+    # Quarto also accepts notebooks and markdown files as chapters
+    existing = existing | {"chapters/tutorials/notebook.ipynb"}
     assert (
-        clean_up_frontmatter("./tests", None, False)["cells"][0]["cell_type"]
-        == "markdown"
+        rename_file_path("chapters/tutorials/notebook.ipynb", existing)
+        == "notebooks/tutorials/notebook"
     )
-    incoming = clean_up_frontmatter("./tests", None, False)["cells"][0]["source"][:52]
-    ref = r"# This a mock Jupyter file\n\*\*We use it for testing\*\*"
-    assert re.match(ref, incoming)
+    # Paths outside the chapters tree still fall back to the file system
+    assert rename_file_path("tests/mock.qmd", existing) == "tests/mock"
+
+
+def test_existing_chapters(tmp_path):
+    (tmp_path / "unit_01").mkdir()
+    (tmp_path / "unit_01" / "exercise.qmd").touch()
+    (tmp_path / "notes.md").touch()
+    assert existing_chapters(tmp_path) == frozenset(
+        {
+            (tmp_path / "unit_01" / "exercise.qmd").as_posix(),
+            (tmp_path / "notes.md").as_posix(),
+        }
+    )
+    assert existing_chapters(tmp_path / "missing") is None
+
 
+@pytest.fixture(scope="session")
+def mock_ipynbs():
+    return tuple(find_ipynb("tests"))
 
-def test_find_ipynb():
-    assert find_ipynb("tests")[0].stem == "mock"
 
+@pytest.fixture(scope="session")
+def mock_nb_bytes():
+    return Path("tests/mock.ipynb").read_bytes()
 
-def test_substitute_path():
-    nb_path = find_ipynb("tests")[0]
+
+@pytest.fixture(scope="session")
+def mock_nb_raw(mock_nb_bytes):
+    return nbformat.reads(mock_nb_bytes, as_version=4)
+
+
+@pytest.fixture
+def mock_nb(mock_nb_raw):
+    # Tests only mutate the metadata, so the cells can be shared
+    nb = copy.copy(mock_nb_raw)
+    nb.metadata = copy.deepcopy(mock_nb_raw.metadata)
+    return nb
+
+
+@pytest.fixture
+def mock_v3_ipynb(tmp_path, mock_nb_raw):
+    nb_path = tmp_path / "mock_v3.ipynb"
+    # Downgrading converts the notebook in place
+    nbformat.write(copy.deepcopy(mock_nb_raw), nb_path, version=3)
+    return nb_path
+
+
+@pytest.fixture
+def mock_src_dir(tmp_path):
+    src = tmp_path / "src"
+    src.mkdir()
+    shutil.copy("tests/mock.ipynb", src / "mock.ipynb")
+    return src
+
+
+@pytest.fixture(scope="module")
+def frontmatter_nb():
+    return clean_up_frontmatter("./tests", None, False)
+
+
+@pytest.fixture(scope="module")
+def refs_nb():
+    return convert_refs("./tests", None, False)
+
+
+@pytest.fixture(scope="module")
+def callout_notes_nb():
+    return convert_callout_notes("./tests", None, False)
+
+
+def test_remove_front_matter(frontmatter_nb):
+    cell = frontmatter_nb["cells"][0]
+    assert cell["cell_type"] == "markdown"
+    assert _FRONTMATTER_RE.match(cell["source"][:52])
+
+
+def test_find_ipynb(mock_ipynbs):
+    assert mock_ipynbs[0].stem == "mock"
+
+
+def test_find_ipynb_skips_checkpoints(tmp_path):
+    nb_paths = [
+        "a.ipynb",
+        "unit_01/b.ipynb",
+        ".ipynb_checkpoints/a-checkpoint.ipynb",
+        "unit_01/.ipynb_checkpoints/b-checkpoint.ipynb",
+    ]
+    for nb_path in nb_paths:
+        (tmp_path / nb_path).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / nb_path).touch()
+    assert sorted(find_ipynb(tmp_path)) == [
+        tmp_path / "a.ipynb",
+        tmp_path / "unit_01" / "b.ipynb",
+    ]
+
+
+def test_substitute_path(mock_ipynbs):
+    nb_path = mock_ipynbs[0]
     assert substitute_path(nb_path, "./tests", "./tests/tests") == Path(
         "./tests/tests/mock.ipynb"
     )
     assert substitute_path(nb_path, "./tests", None) == Path("./tests/mock.ipynb")
 
 
-def test_conversion_of_refs():
-    quarto = [
-        r"lorem ipsum [@anon2024] and [@anon2025]",
-        r"lorem ipsum @anon2024 and @anon2025",
-    ]
-    quarto[0] = quarto_ref_person_replace(quarto[0])
-    quarto[1] = quarto_ref_time_replace(quarto[1])
-    assert quarto == [
-        r"lorem ipsum {cite:p}`anon2024` and {cite:p}`anon2025`",
-        r"lorem ipsum {cite:t}`anon2024` and {cite:t}`anon2025`",
-    ]
-    incoming = convert_refs("./tests", None, False)["cells"][0]["source"][245:]
-    ref = r"lorem ipsum {cite:p}`anon2024` and {cite:p}`anon2025` and lorem ipsum {cite:t}`anon2024` and {cite:t}`anon2025`\n"
-    assert re.match(ref, incoming)
+@pytest.mark.parametrize(
+    "replace, quarto, expected",
+    [
+        (
+            quarto_ref_person_replace,
+            r"lorem ipsum [@anon2024] and [@anon2025]",
+            r"lorem ipsum {cite:p}`anon2024` and {cite:p}`anon2025`",
+        ),
+        (
+            quarto_ref_time_replace,
+            r"lorem ipsum @anon2024 and @anon2025",
+            r"lorem ipsum {cite:t}`anon2024` and {cite:t}`anon2025`",
+        ),
+        (quarto_ref_time_replace, "[@anon2024]", "[@anon2024]"),
+        # Keys with regex metacharacters are matched literally
+        (quarto_ref_person_replace, "[@a.b+c]", "{cite:p}`a.b+c`"),
+        (quarto_ref_time_replace, "@a.b+c", "{cite:t}`a.b+c`"),
+        (quarto_ref_figure_replace, "(@fig.a+b)", ""),
+    ],
+)
+def test_replacement_of_refs(replace, quarto, expected):
+    assert replace(quarto) == expected
 
 
-def test_conversion_of_callout_notes():
-    ref = r":::{note}\nThis a callout note.\n:::"
-    incoming = quarto_note_replace(r"::: {.callout-note}\nThis a callout note.\n:::")
-    assert re.match(ref, incoming)
-    ref = convert_callout_notes("./tests", None, False)["cells"][0]["source"][199:233]
-    assert re.match(ref, incoming)
+def test_conversion_of_refs(refs_nb):
+    incoming = refs_nb["cells"][0]["source"][245:]
+    assert _REFS_RE.match(incoming)
 
 
-def test_setting_kernelspec():
-    meta_mock_nb = nbformat.read("tests/mock.ipynb", as_version=4).metadata
+def test_conversion_of_callout_notes(callout_notes_nb):
+    incoming = quarto_note_replace("::: {.callout-note}\nThis a callout note.\n:::")
+    assert _EXPECTED_NOTE_RE.match(incoming)
+    converted = callout_notes_nb["cells"][0]["source"][199:233]
+    assert converted == incoming
+    # Colons inside the note body no longer stop the conversion
+    incoming = quarto_note_replace("::: {.callout-note}\nA: b\n:::")
+    assert incoming == ":::{note}\nA: b\n:::"
+
+
+def test_setting_kernelspec(mock_nb):
+    meta_mock_nb = mock_nb.metadata
     kernel_display_name_mock_nb = meta_mock_nb.kernelspec.display_name
     kernel_name_mock_nb = meta_mock_nb.kernelspec.name
     new_meta_mock_nb = set_kernel_all_notebooks(dir="tests", save=False).metadata
     assert kernel_display_name_mock_nb != new_meta_mock_nb.kernelspec.display_name
     assert kernel_name_mock_nb != new_meta_mock_nb.kernelspec.name
+
+
+def test_setting_kernelspec_preloaded(mock_nb, mock_nb_raw):
+    new_meta_mock_nb = set_kernel_all_notebooks(nb=mock_nb).metadata
+    assert new_meta_mock_nb.kernelspec.name == "python3"
+    assert new_meta_mock_nb.kernelspec.display_name == "Python 3 (ipykernel)"
+    assert mock_nb_raw.metadata.kernelspec.name != "python3"
+
+
+def test_read_notebook(mock_nb_raw):
+    nb = read_notebook("tests/mock.ipynb")
+    assert nb == mock_nb_raw
+
+
+def test_read_notebook_converts_v3(mock_v3_ipynb, mock_nb_raw):
+    nb = read_notebook(mock_v3_ipynb)
+    assert nb.nbformat == 4
+    assert nb.metadata.kernelspec == mock_nb_raw.metadata.kernelspec
+    assert nb.cells[0].source == mock_nb_raw.cells[0].source
+
+
+def _assert_converted(nb):
+    source = nb.cells[0].source
+    assert nb.cells[0].cell_type == "markdown"
+    assert _FRONTMATTER_RE.match(source)
+    assert ":::{note}\nThis a callout note.\n:::" in source
+    assert "{cite:p}`anon2024` and {cite:p}`anon2025`" in source
+    assert "{cite:t}`anon2024` and {cite:t}`anon2025`" in source
+    assert nb.metadata.kernelspec.name == "python3"
+    assert nb.metadata.kernelspec.display_name == "Python 3 (ipykernel)"
+
+
+def test_process_notebook_writes_to_out(mock_src_dir, tmp_path, mock_nb_bytes):
+    out = tmp_path / "out"
+    process_notebook(mock_src_dir / "mock.ipynb", mock_src_dir, out)
+    _assert_converted(read_notebook(out / "mock.ipynb"))
+    assert (mock_src_dir / "mock.ipynb").read_bytes() == mock_nb_bytes
+
+
+def test_process_notebook_skips_unchanged(mock_src_dir):
+    nb_path = mock_src_dir / "mock.ipynb"
+    process_notebook(nb_path, mock_src_dir)
+    _assert_converted(read_notebook(nb_path))
+    # Backdate the converted notebook so a rewrite would be detected
+    os.utime(nb_path, ns=(0, 0))
+    process_notebook(nb_path, mock_src_dir)
+    assert nb_path.stat().st_mtime_ns == 0
+
+
+def test_clean_nb(mock_src_dir, tmp_path):
+    (mock_src_dir / "unit_01").mkdir()
+    shutil.copy("tests/mock.ipynb", mock_src_dir / "unit_01" / "mock.ipynb")
+    out = tmp_path / "out"
+    clean_nb(mock_src_dir, out)
+    _assert_converted(read_notebook(out / "mock.ipynb"))
+    _assert_converted(read_notebook(out / "unit_01" / "mock.ipynb"))
+    # The bibliography is converted from the repository notebooks afterwards
+    references = read_notebook(out / "references.ipynb")
+    assert references.cells[0].source.startswith("# References\n```{bibliography}")
+
+
+def test_apply_kernelspec_tracks_changes(mock_nb):
+    assert _apply_kernelspec(mock_nb)
+    assert not _apply_kernelspec(mock_nb)
+
+
+def test_replace_markdown_tracks_changes(mock_nb_raw):
+    nb = copy.deepcopy(mock_nb_raw)
+    nb.cells.append(nbformat.v4.new_code_cell("print('[@anon2024]')"))
+    assert not _replace_markdown(nb, quarto_ref_figure_replace)
+    assert _replace_markdown(nb, quarto_ref_person_replace)
+    assert "{cite:p}`anon2024`" in nb.cells[0].source
+    assert nb.cells[1].source == "print('[@anon2024]')"
+    assert not _replace_markdown(nb, quarto_ref_person_replace)